@@ -6,15 +6,27 @@ Uses the CLI internally for reliable image processing.
 First run downloads code (~50MB) and models (~6GB).
 """
 
+import asyncio
+import atexit
+import bisect
+import functools
+import hashlib
 import io
+import json
 import os
 import sys
 import base64
 import shutil
+import struct
 import subprocess
 import tempfile
+import threading
+import time
 import traceback
-from contextlib import asynccontextmanager
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from typing import Optional
 from pathlib import Path
 
@@ -30,6 +42,53 @@ print(f"SeedVR2 repo: {SEEDVR2_REPO_DIR}")
 print("=" * 60)
 
 
+if sys.platform == "win32":
+    import msvcrt
+
+    def _try_lock(f) -> bool:
+        try:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def _unlock(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _try_lock(f) -> bool:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def _unlock(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def file_lock(path: Path, timeout: float = 600.0):
+    """
+    Cross-process advisory lock (no extra deps). The kernel drops the lock
+    automatically when the holder exits, so a crashed or OOM-killed worker can
+    never orphan it - the zero-byte lockfile itself is harmless and stays.
+    """
+    deadline = time.monotonic() + timeout
+    with open(path, "a+") as f:
+        while not _try_lock(f):
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Timed out waiting for lock: {path}")
+            time.sleep(0.5)
+        try:
+            yield
+        finally:
+            _unlock(f)
+
+
 def setup_seedvr2():
     """Download and setup the SeedVR2 repository"""
     if (SEEDVR2_REPO_DIR / "inference_cli.py").exists():
@@ -57,40 +116,54 @@ def setup_seedvr2():
     try:
         import urllib.request
         import zipfile
-        
+
         zip_url = "https://github.com/numz/ComfyUI-SeedVR2_VideoUpscaler/archive/refs/heads/main.zip"
-        zip_path = SCRIPT_DIR / "seedvr2_temp.zip"
-        
+
+        # Stream the download and extract from the spool, so the ~50MB zip
+        # never needs a separate write-then-reread on disk
         print("Downloading zip from GitHub...")
-        urllib.request.urlretrieve(zip_url, zip_path)
-        
-        print("Extracting...")
-        with zipfile.ZipFile(zip_path, 'r') as zf:
-            zf.extractall(SCRIPT_DIR)
-        
+        with urllib.request.urlopen(zip_url) as response, \
+                tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as spool:
+            shutil.copyfileobj(response, spool, length=1 << 20)
+
+            print("Extracting...")
+            spool.seek(0)
+            with zipfile.ZipFile(spool) as zf:
+                zf.extractall(SCRIPT_DIR)
+
         extracted = SCRIPT_DIR / "ComfyUI-SeedVR2_VideoUpscaler-main"
         if extracted.exists():
             if SEEDVR2_REPO_DIR.exists():
                 shutil.rmtree(SEEDVR2_REPO_DIR)
             extracted.rename(SEEDVR2_REPO_DIR)
-        
-        zip_path.unlink(missing_ok=True)
+
         print("Successfully downloaded repository.")
         return True
-        
+
     except Exception as e:
         print(f"Failed to download: {e}")
         return False
 
 
 def install_dependencies():
-    """Install required packages"""
+    """Install required packages (skipped when requirements.txt is unchanged)"""
     requirements = SEEDVR2_REPO_DIR / "requirements.txt"
     if not requirements.exists():
         print("No requirements.txt found!")
         return
-    
-    # Always try to install requirements to ensure all deps are present
+
+    # Skip the pip run on warm boots where requirements.txt hasn't changed
+    # (set SEEDVR2_FORCE_INSTALL=1 to reinstall anyway)
+    deps_hash = hashlib.sha256(requirements.read_bytes()).hexdigest()
+    hash_file = SEEDVR2_REPO_DIR / ".deps_hash"
+    if os.getenv("SEEDVR2_FORCE_INSTALL") != "1":
+        try:
+            if hash_file.exists() and hash_file.read_text().strip() == deps_hash:
+                print("Dependencies unchanged, skipping pip install.")
+                return
+        except OSError:
+            pass
+
     print("Installing/verifying dependencies (this may take a few minutes on first run)...")
     try:
         result = subprocess.run(
@@ -103,6 +176,7 @@ def install_dependencies():
         )
         if result.returncode == 0:
             print("Dependencies installed successfully.")
+            hash_file.write_text(deps_hash)
         else:
             print(f"Pip output: {result.stdout}")
             print(f"Pip errors: {result.stderr}")
@@ -110,21 +184,50 @@ def install_dependencies():
         print(f"Warning installing dependencies: {e}")
 
 
-# Setup
-if not setup_seedvr2():
-    print("ERROR: Could not download SeedVR2.")
-    sys.exit(1)
+# Setup has to happen at import time (the imports below need the installed
+# dependencies), but only one process may do the work: with uvicorn --workers
+# or --reload every sibling waits on the lock and then skips via the marker.
+# The wait budget covers a sibling doing the full clone + pip install.
+SETUP_DONE_MARKER = SCRIPT_DIR / ".setup_done"
 
-install_dependencies()
+try:
+    with file_lock(SCRIPT_DIR / ".setup.lock", timeout=1800.0):
+        if SETUP_DONE_MARKER.exists() and os.getenv("SEEDVR2_FORCE_INSTALL") != "1":
+            print("Setup already completed, skipping.")
+        else:
+            if not setup_seedvr2():
+                print("ERROR: Could not download SeedVR2.")
+                sys.exit(1)
+
+            install_dependencies()
+            SETUP_DONE_MARKER.touch()
+except TimeoutError as e:
+    # Another process is still holding the lock; if it already finished setup
+    # once before, we can serve anyway - otherwise bail out with a clear error
+    if SETUP_DONE_MARKER.exists():
+        print(f"Warning: {e}. Setup marker present, continuing.")
+    else:
+        print(f"ERROR: {e} and setup has never completed.")
+        sys.exit(1)
 print("=" * 60)
 
 # Now import server dependencies
+import inspect
+import numpy as np
 import torch
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import Response
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import FileResponse, Response
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field, validator
 from PIL import Image
 
+# pybase64 runs the same alphabet through SSE4/AVX2 at 3-5 GB/s, an order of
+# magnitude faster than stdlib on the multi-MB payloads we move per request
+try:
+    import pybase64 as b64
+except ImportError:
+    b64 = base64
+
 
 class UpscaleRequest(BaseModel):
     """Request model"""
@@ -145,10 +248,22 @@ class UpscaleRequest(BaseModel):
         return v
 
 
+# Tile size by output max dimension: larger images need smaller tiles
+_TILE_THRESHOLDS = (1024, 2048, 4096)
+_TILE_SIZES = (512, 512, 384, 256)
+
+# blocks_to_swap by output pixel count: offload DiT transformer blocks to CPU
+# for very large images (3B model has 32 blocks; each swapped block saves
+# ~200MB VRAM but adds latency). Thresholds are ~3000^2 through ~6300^2.
+_SWAP_THRESHOLDS = (9_000_000, 16_000_000, 25_000_000, 40_000_000)
+_SWAP_BLOCKS = (0, 8, 16, 24, 32)
+
+
+@functools.lru_cache(maxsize=256)
 def calculate_tile_settings(width: int, height: int, target_resolution: int) -> tuple[int, int, int]:
     """
     Calculate optimal VAE tile size, overlap, and blocks_to_swap based on image dimensions.
-    
+
     Returns (tile_size, tile_overlap, blocks_to_swap)
     """
     # Calculate the output dimensions
@@ -158,38 +273,17 @@ def calculate_tile_settings(width: int, height: int, target_resolution: int) ->
     else:
         out_width = target_resolution
         out_height = int(height * (target_resolution / width))
-    
+
     max_dim = max(out_width, out_height)
     total_pixels = out_width * out_height
-    
-    # Choose tile size based on output resolution
-    # Smaller images can use larger tiles, larger images need smaller tiles
-    if max_dim <= 1024:
-        tile_size = 512
-    elif max_dim <= 2048:
-        tile_size = 512
-    elif max_dim <= 4096:
-        tile_size = 384
-    else:
-        tile_size = 256  # Very large images need smaller tiles
-    
+
+    tile_size = _TILE_SIZES[bisect.bisect_left(_TILE_THRESHOLDS, max_dim)]
+
     # Overlap should be at least 25% of tile size for good blending
     tile_overlap = max(64, tile_size // 4)
-    
-    # blocks_to_swap: offload DiT transformer blocks to CPU for very large images
-    # 3B model has 32 blocks, we can swap 0-32
-    # This trades speed for VRAM - each block swapped saves ~200MB but adds latency
-    if total_pixels > 40_000_000:  # > ~6300x6300 or similar
-        blocks_to_swap = 32  # Swap all blocks for extreme sizes
-    elif total_pixels > 25_000_000:  # > ~5000x5000 or similar
-        blocks_to_swap = 24
-    elif total_pixels > 16_000_000:  # > ~4000x4000 or similar  
-        blocks_to_swap = 16
-    elif total_pixels > 9_000_000:  # > ~3000x3000 or similar
-        blocks_to_swap = 8
-    else:
-        blocks_to_swap = 0  # No swapping needed for smaller images
-    
+
+    blocks_to_swap = _SWAP_BLOCKS[bisect.bisect_left(_SWAP_THRESHOLDS, total_pixels)]
+
     return tile_size, tile_overlap, blocks_to_swap
 
 
@@ -206,35 +300,484 @@ class ServerState:
         self.ready = False
         self.models_downloaded = False
         self.error = None
+        self.pipeline = None
+        self.gpu_sem = None
+        self.batcher = None
 
 
 state = ServerState()
 
+# How many requests may run GPU work at once (>1 risks VRAM OOM)
+GPU_CONCURRENCY = int(os.getenv("SEEDVR2_CONCURRENCY", "1"))
+
+# Max seconds a request waits in the GPU queue before giving up with 503
+REQUEST_TIMEOUT = float(os.getenv("SEEDVR2_REQUEST_TIMEOUT", "300"))
+
+# Cross-process GPU serialization for multi-worker deployments: the semaphore
+# queues within one worker, this lockfile arbitrates between workers
+GPU_LOCK_PATH = SCRIPT_DIR / ".gpu.lock"
+GPU_LOCK_TIMEOUT = float(os.getenv("SEEDVR2_GPU_LOCK_TIMEOUT", "7200"))
+
+
+def gpu_lock():
+    return file_lock(GPU_LOCK_PATH, timeout=GPU_LOCK_TIMEOUT)
+
+# On-disk result cache so retried/replayed requests skip the GPU (0 = disabled)
+CACHE_DIR = SCRIPT_DIR / "cache"
+CACHE_MAX_MB = int(os.getenv("SEEDVR2_CACHE_MAX_MB", "2048"))
+
+# Micro-batching for the in-process backend: requests arriving within the
+# window that share size + parameters run as one forward pass
+BATCH_WINDOW = float(os.getenv("SEEDVR2_BATCH_WINDOW_MS", "15")) / 1000.0
+MAX_BATCH = int(os.getenv("SEEDVR2_MAX_BATCH", "4"))
+MAX_PENDING = int(os.getenv("SEEDVR2_MAX_PENDING", "32"))
+
+
+def cache_key(image_data: bytes, request: UpscaleRequest) -> str:
+    """Hash the raw image bytes plus every parameter that affects the output"""
+    params = json.dumps(request.dict(exclude={"image_base64", "name"}), sort_keys=True)
+    return hashlib.sha256(image_data + params.encode()).hexdigest()
+
+
+def cache_path(key: str) -> Path:
+    return CACHE_DIR / key[:2] / f"{key}.png"
+
+
+def cache_lookup(key: str) -> Optional[Path]:
+    """Return the cached PNG for this key if present, refreshing its LRU stamp"""
+    if CACHE_MAX_MB <= 0:
+        return None
+    path = cache_path(key)
+    if path.exists():
+        try:
+            os.utime(path)  # Mark recently used so eviction skips it
+        except OSError:
+            pass
+        return path
+    return None
+
+
+def cache_store(key: str, output, tmpdir):
+    """
+    Move the upscale output into the cache, returning the (output, tmpdir) the
+    caller should use onward. CLI outputs become the cache file itself so no
+    extra copy is made; failures just skip caching.
+    """
+    if CACHE_MAX_MB <= 0:
+        return output, tmpdir
+
+    try:
+        path = cache_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.parent / f"{key}.{os.getpid()}.tmp"
+
+        if isinstance(output, Path):
+            shutil.move(str(output), str(tmp))
+            os.replace(tmp, path)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return path, None
+
+        tmp.write_bytes(output)
+        os.replace(tmp, path)
+        return output, tmpdir
+    except Exception as e:
+        print(f"Warning: could not store cache entry: {e}")
+        return output, tmpdir
+
+
+def evict_cache():
+    """Trim the cache to CACHE_MAX_MB, removing least recently used entries first"""
+    try:
+        entries = sorted(CACHE_DIR.glob("*/*.png"), key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in entries)
+        limit = CACHE_MAX_MB * 1024 * 1024
+        for path in entries:
+            if total <= limit:
+                break
+            size = path.stat().st_size
+            path.unlink(missing_ok=True)
+            total -= size
+    except Exception as e:
+        print(f"Warning: cache eviction failed: {e}")
+
+
+async def cache_sweeper():
+    """Background task keeping the result cache under its size cap"""
+    while True:
+        await asyncio.to_thread(evict_cache)
+        await asyncio.sleep(300)
+
+
+# Marker so later cold starts know the ~6GB models are already on disk
+MODELS_READY_MARKER = SCRIPT_DIR / ".models_ready"
+
 
 def check_models():
-    """Check if models are downloaded by doing a dry run"""
-    # Models auto-download on first CLI run
+    """Mark the server ready, reporting whether models are already resident"""
+    state.models_downloaded = MODELS_READY_MARKER.exists()
     state.ready = True
-    state.models_downloaded = True
-    print("Server ready. Models will download on first upscale request.")
+    if state.models_downloaded:
+        print("Server ready. Models loaded.")
+    else:
+        print("Server ready. Models will download on first upscale request.")
 
 
-def upscale_with_cli(image: Image.Image, request: UpscaleRequest) -> Image.Image:
-    """Upscale using the SeedVR2 CLI"""
-    
-    # Create temp directory manually for better control on Windows
-    tmpdir = Path(tempfile.mkdtemp())
+def warmup():
+    """Run a tiny dummy inference so model download + VRAM load happen at startup"""
+    request = UpscaleRequest(resolution=64, seed=0, image_base64="")
+    image = Image.new("RGB", (64, 64))
+    output, _, _, tmpdir = run_upscale(image, request)
+    if tmpdir is not None:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    MODELS_READY_MARKER.touch()
+
+
+def load_pipeline():
+    """Import the pipeline that inference_cli.py wraps and keep it resident in VRAM"""
+    if str(SEEDVR2_REPO_DIR) not in sys.path:
+        sys.path.insert(0, str(SEEDVR2_REPO_DIR))
+
+    import inference_cli
+
+    # Class name has shifted between upstream versions, try the known ones
+    candidates = ["SeedVR2Pipeline", "VideoUpscalerPipeline", "Pipeline"]
+    for name in candidates:
+        cls = getattr(inference_cli, name, None)
+        if cls is not None:
+            print(f"Loading SeedVR2 pipeline ({name})...")
+            return cls()
+    raise RuntimeError(f"No pipeline class found in inference_cli (tried {candidates})")
+
+
+def png_dimensions(path: Path) -> tuple[int, int]:
+    """Read width/height straight from the PNG IHDR chunk, skipping PIL entirely"""
+    with open(path, "rb") as f:
+        header = f.read(24)
+    if len(header) == 24 and header[12:16] == b"IHDR":
+        return struct.unpack(">II", header[16:24])
+    # Not a plain PNG header - let PIL figure it out
+    with Image.open(path) as img:
+        return img.size
+
+
+def image_to_tensor(image: Image.Image) -> torch.Tensor:
+    """Convert a PIL image to a [height, width, channel] float tensor in 0..1"""
+    return torch.from_numpy(np.asarray(image, dtype=np.float32) / 255.0)
+
+
+def to_output_image(output) -> Image.Image:
+    """Convert a pipeline output (tensor or PIL image) back to a PIL image"""
+    if isinstance(output, torch.Tensor):
+        array = output.clamp(0.0, 1.0).mul(255.0).round().byte().cpu().numpy()
+        return Image.fromarray(array, "RGB")
+    return output
+
+
+def encode_png(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def pipeline_kwargs(image: Image.Image, request: UpscaleRequest, fn) -> dict:
+    """Build the pipeline call kwargs, dropping any the installed version lacks"""
+    tile_size, tile_overlap, blocks_to_swap = calculate_tile_settings(
+        image.width, image.height, request.resolution
+    )
+    print(f"Using VAE tiling: tile_size={tile_size}, tile_overlap={tile_overlap}, blocks_to_swap={blocks_to_swap}")
+
+    kwargs = dict(
+        resolution=request.resolution,
+        seed=request.seed,
+        color_correction=request.color_correction,
+        tile_size=tile_size,
+        tile_overlap=tile_overlap,
+        blocks_to_swap=blocks_to_swap,
+    )
+
+    if request.max_resolution > 0:
+        kwargs["max_resolution"] = request.max_resolution
+
+    if request.input_noise_scale > 0:
+        kwargs["input_noise_scale"] = request.input_noise_scale
+
+    if request.latent_noise_scale > 0:
+        kwargs["latent_noise_scale"] = request.latent_noise_scale
+
+    # Drop options the pipeline doesn't know about (signatures vary between upstream versions)
+    accepted = accepted_params(fn)
+    if accepted is not None:
+        kwargs = {k: v for k, v in kwargs.items() if k in accepted}
+
+    return kwargs
+
+
+@functools.lru_cache(maxsize=8)
+def accepted_params(fn) -> Optional[frozenset]:
+    """Keyword names fn accepts, or None when it takes **kwargs (cached -
+    inspect.signature is surprisingly expensive to run per request)"""
+    params = inspect.signature(fn).parameters
+    if any(p.kind == p.VAR_KEYWORD for p in params.values()):
+        return None
+    return frozenset(params)
+
+
+def upscale_inproc(image: Image.Image, request: UpscaleRequest):
+    """Upscale using the resident in-process pipeline (no subprocess, no disk round-trip)"""
+    kwargs = pipeline_kwargs(image, request, state.pipeline.run)
+
+    # Pipeline expects a [batch, height, width, channel] float tensor in 0..1
+    tensor = image_to_tensor(image).unsqueeze(0)
+
+    output = state.pipeline.run(tensor, **kwargs)
+    if isinstance(output, torch.Tensor):
+        output = output.squeeze(0)
+
+    output_image = to_output_image(output)
+    return encode_png(output_image), output_image.width, output_image.height, None
+
+
+def upscale_inproc_batch(images: list, request: UpscaleRequest) -> list:
+    """Upscale a stack of same-size, same-parameter images in one forward pass"""
+    kwargs = pipeline_kwargs(images[0], request, state.pipeline.run_batch)
+    stacked = torch.stack([image_to_tensor(image) for image in images])
+
+    outputs = state.pipeline.run_batch(stacked, **kwargs)
+
+    results = []
+    for i in range(len(images)):
+        output_image = to_output_image(outputs[i])
+        results.append((encode_png(output_image), output_image.width, output_image.height, None))
+    return results
+
+
+def run_upscale(image: Image.Image, request: UpscaleRequest):
+    """
+    Upscale in-process when the pipeline loaded, otherwise fall back to the CLI.
+
+    Returns (output, width, height, tmpdir) where output is PNG bytes (in-process)
+    or a Path to the PNG on disk (CLI); tmpdir must be removed after the file is used.
+    """
+    with gpu_lock():
+        if state.pipeline is not None:
+            return upscale_inproc(image, request)
+        return upscale_with_cli(image, request)
+
+
+def upscale_and_cache(key: str, image: Image.Image, request: UpscaleRequest):
+    """Run the upscale and persist the result under its cache key"""
+    output, width, height, tmpdir = run_upscale(image, request)
+    output, tmpdir = cache_store(key, output, tmpdir)
+    return output, width, height, tmpdir
+
+
+def upscale_batch_and_cache(entries: list, request: UpscaleRequest) -> list:
+    """Upscale a group of compatible (key, image) entries, caching each result"""
+    images = [image for _, image in entries]
+    if state.pipeline is not None and len(images) > 1 and hasattr(state.pipeline, "run_batch"):
+        with gpu_lock():
+            outputs = upscale_inproc_batch(images, request)
+    else:
+        outputs = [run_upscale(image, request) for image in images]
+
+    results = []
+    for (key, _), (output, width, height, tmpdir) in zip(entries, outputs):
+        output, tmpdir = cache_store(key, output, tmpdir)
+        results.append((output, width, height, tmpdir))
+    return results
+
+
+class MicroBatcher:
+    """
+    Coalesce requests that arrive within a short window into one forward pass.
+
+    Only requests with identical input size and parameters batch together -
+    retries, client replays, and tiling pipelines sending same-size crops are
+    the realistic coalescible traffic, and they need no padding logic.
+    """
+
+    def __init__(self, window: float, max_batch: int, max_pending: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.pending = []
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    @staticmethod
+    def signature(image: Image.Image, request: UpscaleRequest) -> tuple:
+        params = request.dict(exclude={"image_base64", "name"})
+        return (image.size,) + tuple(sorted(params.items()))
+
+    async def submit(self, key: str, image: Image.Image, request: UpscaleRequest):
+        if len(self.pending) >= self.max_pending:
+            raise HTTPException(status_code=503, detail="GPU busy, try again later")
+        future = asyncio.get_running_loop().create_future()
+        entry = (self.signature(image, request), key, image, request, future)
+        self.pending.append(entry)
+        self.wakeup.set()
+        # Same saturation contract as the non-batched path: the full wait -
+        # queueing behind earlier batches included - counts against
+        # REQUEST_TIMEOUT, not just the semaphore acquire inside run()
+        try:
+            return await asyncio.wait_for(future, timeout=REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            if entry in self.pending:
+                self.pending.remove(entry)
+            raise HTTPException(status_code=503, detail="GPU busy, try again later")
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+
+            # Give near-simultaneous requests a moment to arrive
+            await asyncio.sleep(self.window)
+
+            # Everything pending may have timed out and withdrawn meanwhile
+            if not self.pending:
+                self.wakeup.clear()
+                continue
+
+            sig = self.pending[0][0]
+            batch = [entry for entry in self.pending if entry[0] == sig][:self.max_batch]
+            for entry in batch:
+                self.pending.remove(entry)
+            if not self.pending:
+                self.wakeup.clear()
+
+            futures = [entry[4] for entry in batch]
+            try:
+                await asyncio.wait_for(state.gpu_sem.acquire(), timeout=REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(
+                            HTTPException(status_code=503, detail="GPU busy, try again later")
+                        )
+                continue
+
+            try:
+                if len(batch) > 1:
+                    print(f"Micro-batching {len(batch)} compatible requests")
+                results = await asyncio.to_thread(
+                    upscale_batch_and_cache,
+                    [(entry[1], entry[2]) for entry in batch],
+                    batch[0][3],
+                )
+                for future, result in zip(futures, results):
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                state.gpu_sem.release()
+
+
+def decode_image(image_data: bytes) -> Image.Image:
+    """
+    Validate and decode an image payload, raising 400 on garbage input so
+    malformed requests never occupy a GPU queue slot.
+    """
+    try:
+        probe = Image.open(io.BytesIO(image_data))
+        probe.verify()
+        # verify() consumes the parser, so re-open for actual use
+        return Image.open(io.BytesIO(image_data)).convert("RGB")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+
+
+def short_circuit_resize(image: Image.Image, request: UpscaleRequest):
+    """
+    When the target short side is not larger than the input's, a plain LANCZOS
+    resize is indistinguishable from the diffusion pipeline - return
+    (png_bytes, width, height) for that case, None otherwise.
+    """
+    if request.resolution > min(image.width, image.height):
+        return None
+
+    # Noise injection visibly changes what the pipeline produces; there is no
+    # cheap equivalent, so hand those requests to the real backend
+    if request.input_noise_scale > 0 or request.latent_noise_scale > 0:
+        return None
+
+    if image.height < image.width:
+        height = request.resolution
+        width = round(image.width * request.resolution / image.height)
+    else:
+        width = request.resolution
+        height = round(image.height * request.resolution / image.width)
+
+    # Honor the client's cap the same way the CLI does: scale the target down
+    # so the long side never exceeds max_resolution
+    if request.max_resolution > 0 and max(width, height) > request.max_resolution:
+        scale = request.max_resolution / max(width, height)
+        width = round(width * scale)
+        height = round(height * scale)
+
+    print(f"Target {request.resolution} <= input short side, resizing without the GPU")
+    resized = image.resize((width, height), Image.LANCZOS)
+    return encode_png(resized), width, height
+
+
+async def run_upscale_queued(key: str, image: Image.Image, request: UpscaleRequest):
+    """Run an upscale through the micro-batcher, or directly under the GPU semaphore"""
+    if state.batcher is not None:
+        return await state.batcher.submit(key, image, request)
+
+    await acquire_gpu()
+    try:
+        return await asyncio.to_thread(upscale_and_cache, key, image, request)
+    finally:
+        state.gpu_sem.release()
+
+
+def read_output_bytes(output, tmpdir) -> bytes:
+    """Materialize the upscale output as bytes, cleaning up the CLI tmpdir if any"""
+    if isinstance(output, Path):
+        try:
+            return output.read_bytes()
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+    return output
+
+
+# One scratch directory per worker, removed at exit; per-request files get
+# unique names inside it so we skip a mkdtemp+rmtree pair on every call
+# (both are slow on Windows thanks to defender scans and handle churn)
+WORKDIR = Path(tempfile.mkdtemp(prefix="seedvr2_"))
+atexit.register(shutil.rmtree, WORKDIR, ignore_errors=True)
+
+# Fixed argv prefix for the CLI fallback; per-request args extend a copy
+CLI_CMD_PREFIX = (sys.executable, str(SEEDVR2_REPO_DIR / "inference_cli.py"))
+
+
+def upscale_with_cli(image: Image.Image, request: UpscaleRequest):
+    """Upscale using the SeedVR2 CLI, returning the output file still on disk"""
+
+    uid = uuid.uuid4().hex
+    input_path = WORKDIR / f"in_{uid}.tiff"
+    output_dir = WORKDIR / f"out_{uid}"
     try:
-        input_path = tmpdir / "input.png"
-        output_dir = tmpdir / "output"
         output_dir.mkdir()
-        
-        # Save input image
-        image.save(input_path, "PNG")
+
+        # Save input uncompressed - PNG's DEFLATE encode costs seconds on 4K
+        # images and the file only lives long enough for the CLI to read it
+        image.save(input_path, "TIFF", compression=None)
         
         # Build CLI command
         cmd = [
-            sys.executable, str(SEEDVR2_REPO_DIR / "inference_cli.py"),
+            *CLI_CMD_PREFIX,
             str(input_path),
             "--output", str(output_dir),
             "--resolution", str(request.resolution),
@@ -279,76 +822,226 @@ def upscale_with_cli(image: Image.Image, request: UpscaleRequest) -> Image.Image
         env["PYTHONIOENCODING"] = "utf-8"
         env["PYTHONLEGACYWINDOWSSTDIO"] = "0"
         
-        # Run CLI (timeout is very long to support slow hardware)
-        result = subprocess.run(
+        # Stream CLI output live instead of capture_output - the per-tile
+        # progress logs can reach megabytes over a long run and a full pipe
+        # buffer would deadlock; keep only a short tail for error reporting
+        proc = subprocess.Popen(
             cmd,
             cwd=str(SEEDVR2_REPO_DIR),
-            capture_output=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=1,
             text=True,
-            timeout=7200,  # 2 hour timeout for slow hardware
             env=env,
             encoding="utf-8",
             errors="replace"
         )
-        
-        if result.returncode != 0:
-            print(f"CLI stdout: {result.stdout}")
-            print(f"CLI stderr: {result.stderr}")
-            raise RuntimeError(f"CLI failed: {result.stderr or result.stdout}")
-        
+        # Drain stdout from a thread so the timeout applies to the whole run:
+        # reading the pipe inline would block until the CLI closes it, making
+        # wait(timeout=...) unreachable while a hung process keeps the GPU
+        tail = deque(maxlen=50)
+
+        def pump_output():
+            for line in proc.stdout:
+                line = line.rstrip()
+                print(f"[CLI] {line}")
+                tail.append(line)
+
+        reader = threading.Thread(target=pump_output, daemon=True)
+        reader.start()
+        try:
+            returncode = proc.wait(timeout=7200)  # 2 hour timeout for slow hardware
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            reader.join(timeout=10)
+            raise RuntimeError(
+                "CLI timed out after 2 hours and was killed. Last output:\n"
+                + "\n".join(tail)
+            )
+        reader.join(timeout=10)
+        cli_tail = "\n".join(tail)
+
+        if returncode != 0:
+            raise RuntimeError(f"CLI failed: {cli_tail}")
+
         print(f"CLI completed. Searching for output...")
         
-        # The CLI saves output with the same name as input in the output directory
-        # So we look for input.png in the OUTPUT directory (not the temp root)
-        output_file = output_dir / "input.png"
+        # The CLI saves output named after the input in the output directory;
+        # depending on the version that may be in_<uid>.png or keep the input
+        # extension, so probe both before falling back to anything it wrote
+        output_file = output_dir / f"in_{uid}.png"
+        if not output_file.exists():
+            output_file = output_dir / input_path.name
         
         if output_file.exists():
             print(f"Found output file: {output_file}")
         else:
-            # Fallback: search for any PNG in output directory
-            output_files = list(output_dir.glob("*.png")) if output_dir.exists() else []
+            # Fallback: accept any file the CLI left in the output directory
+            output_files = [p for p in output_dir.glob("*") if p.is_file()] if output_dir.exists() else []
             if output_files:
                 output_file = output_files[0]
                 print(f"Found output file (fallback): {output_file}")
             else:
                 # List what's actually in the directories for debugging
-                print(f"Contents of tmpdir: {list(tmpdir.iterdir())}")
+                print(f"Contents of workdir: {list(WORKDIR.iterdir())}")
                 if output_dir.exists():
                     print(f"Contents of output_dir: {list(output_dir.iterdir())}")
-                raise RuntimeError(f"No output file found. CLI output: {result.stdout}")
-        
-        # Load the output image into memory before cleanup
-        print(f"Loading output from: {output_file}")
-        
-        # Read raw bytes to preserve exact output from CLI
-        output_bytes = output_file.read_bytes()
-        
-        # Get dimensions from the image
-        with Image.open(output_file) as img:
-            width, height = img.size
-        
-        return output_bytes, width, height
+                raise RuntimeError(f"No output file found. CLI output: {cli_tail}")
         
+        # Get dimensions from the PNG header without a PIL decode
+        width, height = png_dimensions(output_file)
+
+        # The caller owns output_dir now and removes it once the file has
+        # been read or streamed out - avoids buffering the whole PNG here
+        return output_file, width, height, output_dir
+
+    except Exception:
+        # Clean up the output directory manually, ignoring errors on Windows
+        shutil.rmtree(output_dir, ignore_errors=True)
+        raise
     finally:
-        # Clean up temp directory manually, ignoring errors on Windows
-        try:
-            import shutil
-            shutil.rmtree(tmpdir, ignore_errors=True)
-        except Exception as e:
-            print(f"Warning: Could not clean up temp dir: {e}")
+        input_path.unlink(missing_ok=True)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    check_models()
+    # Upscales run on worker threads so the event loop stays free for /health
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(
+        ThreadPoolExecutor(max_workers=int(os.getenv("SEEDVR2_WORKERS", "2")))
+    )
+    # With multiple forked workers each would load its own ~6GB copy of the
+    # model - the .gpu.lock serializes compute but not VRAM residency, and two
+    # resident copies OOM a typical 8-16GB GPU. Use the CLI backend instead,
+    # which only holds the model for the duration of a run.
+    web_workers = int(os.getenv("SEEDVR2_WEB_WORKERS", "1"))
+    if web_workers > 1:
+        print(f"{web_workers} web workers configured: skipping the in-process "
+              "pipeline to avoid one resident model copy per worker. Using the CLI backend.")
+        state.pipeline = None
+    else:
+        try:
+            state.pipeline = load_pipeline()
+            print("Pipeline loaded. Model stays resident in VRAM between requests.")
+        except Exception as e:
+            print(f"Warning: could not load in-process pipeline ({e}). Falling back to CLI per request.")
+            state.pipeline = None
+    state.gpu_sem = asyncio.Semaphore(GPU_CONCURRENCY)
+    sweeper = asyncio.create_task(cache_sweeper()) if CACHE_MAX_MB > 0 else None
+
+    if state.pipeline is not None and MAX_BATCH > 1:
+        state.batcher = MicroBatcher(BATCH_WINDOW, MAX_BATCH, MAX_PENDING)
+        state.batcher.start()
+
+    async def warm_and_mark_ready():
+        # Pay the model download + weight-to-VRAM cost here instead of inside
+        # the first client's request (CLI fallback only warms the first boot).
+        # This runs as a background task so the server starts answering
+        # /health ("starting") right away - the orchestrators poll it with
+        # hard deadlines and treat a refused connection as a dead server.
+        try:
+            if state.pipeline is not None or not MODELS_READY_MARKER.exists():
+                print("Warming up model (first run downloads ~6GB)...")
+                await asyncio.to_thread(warmup)
+        except Exception as e:
+            if state.pipeline is not None:
+                # The pipeline class imported but its run() contract doesn't
+                # match this upstream version - drop to the known-good CLI
+                # rather than 500 every request against a broken pipeline
+                print(f"Warning: in-process warmup failed ({e}). Falling back to CLI per request.")
+                state.pipeline = None
+                if state.batcher is not None:
+                    state.batcher.stop()
+                    state.batcher = None
+                try:
+                    if not MODELS_READY_MARKER.exists():
+                        await asyncio.to_thread(warmup)
+                except Exception as e:
+                    state.error = f"Warmup failed: {e}"
+                    print(f"Warning: warmup failed: {e}")
+            else:
+                state.error = f"Warmup failed: {e}"
+                print(f"Warning: warmup failed: {e}")
+
+        check_models()
+
+    warmer = asyncio.create_task(warm_and_mark_ready())
     yield
+    warmer.cancel()
+    if state.batcher is not None:
+        state.batcher.stop()
+    if sweeper is not None:
+        sweeper.cancel()
+
+
+async def acquire_gpu():
+    """Wait for a GPU slot, returning 503 if the queue stays saturated too long"""
+    try:
+        await asyncio.wait_for(state.gpu_sem.acquire(), timeout=REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="GPU busy, try again later")
+
+
+def png_file_response(path: Path, width: int, height: int, tmpdir=None):
+    """Stream a PNG from disk, deferring tmpdir cleanup until the response is sent"""
+    background = None
+    if tmpdir is not None:
+        background = BackgroundTask(shutil.rmtree, tmpdir, ignore_errors=True)
+    return FileResponse(
+        path,
+        media_type="image/png",
+        headers={
+            "X-Image-Width": str(width),
+            "X-Image-Height": str(height),
+        },
+        background=background,
+    )
+
+
+def cached_png_response(path: Path):
+    """Serve a cache hit straight from disk"""
+    width, height = png_dimensions(path)
+    return png_file_response(path, width, height)
+
+
+async def upscale_to_png_response(key: str, input_image: Image.Image, request: UpscaleRequest):
+    """Run the upscale and wrap the PNG output in a binary response"""
+    output, width, height, tmpdir = await run_upscale_queued(key, input_image, request)
+
+    if isinstance(output, Path):
+        # Stream straight from disk instead of buffering the whole PNG in RAM
+        return png_file_response(output, width, height, tmpdir)
+
+    return Response(
+        content=output,
+        media_type="image/png",
+        headers={
+            "X-Image-Width": str(width),
+            "X-Image-Height": str(height),
+        },
+    )
+
+
+# orjson serializes the multi-MB base64 response strings several times faster
+# than stdlib json; fall back quietly when it isn't installed
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+except ImportError:
+    from fastapi.responses import JSONResponse as DefaultResponse
 
 
 app = FastAPI(
     title="SeedVR2 Upscaler API",
-    description="Image upscaling using SeedVR2 (auto-downloads models)",
+    description=(
+        "Image upscaling using SeedVR2 (auto-downloads models). "
+        "Prefer /upscale/raw or /upscale/binary for large images - they skip "
+        "the base64 + JSON encoding entirely."
+    ),
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=DefaultResponse,
 )
 
 
@@ -358,7 +1051,7 @@ async def health_check():
         "status": "healthy" if state.ready else "starting",
         "models_ready": state.models_downloaded,
         "error": state.error,
-        "note": "Models download automatically on first request (~6GB)"
+        "note": None if state.models_downloaded else "Models download automatically at startup (~6GB)"
     }
 
 
@@ -366,40 +1059,72 @@ async def health_check():
 async def upscale_endpoint(request: UpscaleRequest):
     if not state.ready:
         raise HTTPException(status_code=503, detail="Server not ready")
-    
+
+    # Log all request parameters from C#
+    print(f"\n{'='*60}")
+    print(f"UPSCALE REQUEST RECEIVED:")
+    print(f"  name: {request.name}")
+    print(f"  resolution: {request.resolution}")
+    print(f"  max_resolution: {request.max_resolution}")
+    print(f"  seed: {request.seed}")
+    print(f"  color_correction: {request.color_correction}")
+    print(f"  input_noise_scale: {request.input_noise_scale}")
+    print(f"  latent_noise_scale: {request.latent_noise_scale}")
+    print(f"  image_base64 length: {len(request.image_base64)} chars")
+    print(f"{'='*60}")
+
     try:
-        # Log all request parameters from C#
-        print(f"\n{'='*60}")
-        print(f"UPSCALE REQUEST RECEIVED:")
-        print(f"  name: {request.name}")
-        print(f"  resolution: {request.resolution}")
-        print(f"  max_resolution: {request.max_resolution}")
-        print(f"  seed: {request.seed}")
-        print(f"  color_correction: {request.color_correction}")
-        print(f"  input_noise_scale: {request.input_noise_scale}")
-        print(f"  latent_noise_scale: {request.latent_noise_scale}")
-        print(f"  image_base64 length: {len(request.image_base64)} chars")
-        print(f"{'='*60}")
-        
-        # Decode image
-        image_data = base64.b64decode(request.image_base64)
-        input_image = Image.open(io.BytesIO(image_data)).convert("RGB")
-        
-        print(f"Processing: {input_image.width}x{input_image.height} -> res={request.resolution}")
-        
-        # Upscale - returns raw bytes and dimensions
-        output_bytes, width, height = upscale_with_cli(input_image, request)
-        
+        image_data = b64.b64decode(request.image_base64)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid base64: {e}")
+
+    input_image = decode_image(image_data)
+
+    print(f"Processing: {input_image.width}x{input_image.height} -> res={request.resolution}")
+
+    direct = await asyncio.to_thread(short_circuit_resize, input_image, request)
+    if direct is not None:
+        output_bytes, width, height = direct
+        return UpscaleResponse(
+            success=True,
+            message="Image resized without upscaling (target <= input resolution)",
+            image_base64=b64.b64encode(output_bytes).decode(),
+            width=width,
+            height=height,
+        )
+
+    # Cache hit: answer straight from disk without waiting for a GPU slot
+    key = cache_key(image_data, request)
+    cached = cache_lookup(key)
+    if cached is not None:
+        print(f"Cache hit: {key[:12]}")
+        output_bytes = cached.read_bytes()
+        width, height = png_dimensions(cached)
+        return UpscaleResponse(
+            success=True,
+            message="Image upscaled successfully (cached)",
+            image_base64=b64.b64encode(output_bytes).decode(),
+            width=width,
+            height=height,
+        )
+
+    try:
+        # Upscale - returns PNG bytes or an on-disk path plus dimensions
+        output, width, height, tmpdir = await run_upscale_queued(key, input_image, request)
+        output_bytes = read_output_bytes(output, tmpdir)
+
         print(f"Output size: {len(output_bytes)} bytes, {width}x{height}")
-        
+
         return UpscaleResponse(
             success=True,
             message="Image upscaled successfully",
-            image_base64=base64.b64encode(output_bytes).decode(),
+            image_base64=b64.b64encode(output_bytes).decode(),
             width=width,
             height=height,
         )
-        
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Upscaling failed: {e}")
         print(traceback.format_exc())
@@ -410,26 +1135,104 @@ async def upscale_endpoint(request: UpscaleRequest):
 async def upscale_raw(request: UpscaleRequest):
     if not state.ready:
         raise HTTPException(status_code=503, detail="Server not ready")
-    
+
     try:
-        image_data = base64.b64decode(request.image_base64)
-        input_image = Image.open(io.BytesIO(image_data)).convert("RGB")
-        
-        # Upscale - returns raw bytes and dimensions
-        output_bytes, width, height = upscale_with_cli(input_image, request)
-        
+        image_data = b64.b64decode(request.image_base64)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid base64: {e}")
+
+    input_image = decode_image(image_data)
+
+    direct = await asyncio.to_thread(short_circuit_resize, input_image, request)
+    if direct is not None:
+        output_bytes, width, height = direct
+        return Response(
+            content=output_bytes,
+            media_type="image/png",
+            headers={
+                "X-Image-Width": str(width),
+                "X-Image-Height": str(height),
+            },
+        )
+
+    key = cache_key(image_data, request)
+    cached = cache_lookup(key)
+    if cached is not None:
+        return cached_png_response(cached)
+
+    try:
+        return await upscale_to_png_response(key, input_image, request)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/upscale/binary")
+async def upscale_binary(
+    image: UploadFile = File(..., description="Image file (PNG, JPEG, ...)"),
+    name: str = Form(default=""),
+    resolution: int = Form(default=1080),
+    max_resolution: int = Form(default=0),
+    seed: int = Form(default=42),
+    color_correction: str = Form(default="lab"),
+    input_noise_scale: float = Form(default=0.0),
+    latent_noise_scale: float = Form(default=0.0),
+):
+    """Binary upscale: multipart image in, PNG bytes out - no base64 inflation"""
+    if not state.ready:
+        raise HTTPException(status_code=503, detail="Server not ready")
+
+    request = UpscaleRequest(
+        name=name,
+        resolution=resolution,
+        max_resolution=max_resolution,
+        seed=seed,
+        color_correction=color_correction,
+        input_noise_scale=input_noise_scale,
+        latent_noise_scale=latent_noise_scale,
+        image_base64="",
+    )
+
+    image_data = await image.read()
+    input_image = decode_image(image_data)
+
+    direct = await asyncio.to_thread(short_circuit_resize, input_image, request)
+    if direct is not None:
+        output_bytes, width, height = direct
         return Response(
             content=output_bytes,
             media_type="image/png",
             headers={
                 "X-Image-Width": str(width),
                 "X-Image-Height": str(height),
-            }
+            },
         )
+
+    key = cache_key(image_data, request)
+    cached = cache_lookup(key)
+    if cached is not None:
+        return cached_png_response(cached)
+
+    try:
+        return await upscale_to_png_response(key, input_image, request)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+
+    # Extra workers parallelize the CPU-bound base64/PIL work across cores
+    # while the .gpu.lock keeps actual GPU work serialized. More than one
+    # worker forces the CLI backend (each in-process pipeline would keep its
+    # own ~6GB model in VRAM), so the default of 1 is the faster choice unless
+    # decode/encode is the bottleneck; uvicorn needs the app as an import
+    # string to fork more than one worker
+    workers = int(os.getenv("SEEDVR2_WEB_WORKERS", "1"))
+    if workers > 1:
+        uvicorn.run("SeedVr2Server:app", host="0.0.0.0", port=8000, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file